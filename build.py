@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
-from itertools import islice
+import threading
+from array import array
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from itertools import islice, repeat
 from pathlib import Path
+from queue import Queue
 from typing import Any, Tuple
 
+import numpy as np
 import psycopg
 import pyarrow as pa
 import pyarrow.parquet as pq
 from tqdm.auto import tqdm
-from danbooru_metadata import TagMappings, PostInfo, RATING_MAP, read_duplicates
+from danbooru_metadata import TagMappings, Metadata, RATING_MAP, read_duplicates
 
 
 # Schema for the metadata file
@@ -19,16 +25,28 @@ schema = pa.schema([
 	pa.field("score", pa.int16()),
 ])
 
+# Number of rows handed from the COPY stream to the merge loop at a time
+BATCH_SIZE = 50_000
+
+# A row of the metadata query: (post_id, tag ids, hash, score, rating, duplicate group hash)
+MetadataRow = tuple[int, list[int], bytes, int, int, bytes]
+
+# Number of rows per row group in the Parquet file
+ROW_GROUP_SIZE = 1 << 20
+
+# Parquet path of the tags list's leaf column, used for per-column writer options
+TAGS_COLUMN_PATH = "tags.list.element"
+
 
 def main():
 	db = get_db_connection()
 
 	print("Reading tag aliases, implications, etc...")
-	tag_mappings = TagMappings('../metadata')
-	duplicate_groups = read_duplicates()
+	tag_mappings = TagMappings.load_or_build('../metadata', 'tag_mappings.cache.pkl')
+	hash_to_canonical = read_duplicates()
 
-	# Build a metadata dictionary from the database
-	metadata = build_metadata(db, tag_mappings, duplicate_groups)
+	# Build the metadata arrays from the database
+	metadata = build_metadata(db, tag_mappings, hash_to_canonical)
 
 	# Count tags
 	tag_counts = count_tags(metadata)
@@ -45,8 +63,7 @@ def main():
 
 	# Write top tags to file
 	with open('top_tags.txt', 'w') as f:
-		for tag in top_tags:
-			f.write(tag + '\n')
+		f.write('\n'.join(top_tags) + '\n')
 	
 	# Useful assertions
 	assert 'safe' not in top_tags
@@ -66,155 +83,300 @@ def main():
 def build_metadata(
 	db: psycopg.Connection[Tuple[Any, ...]],
 	tag_mappings: TagMappings,
-	duplicate_groups: list[set[bytes]],
-) -> dict[int, PostInfo]:
+	hash_to_canonical: dict[bytes, bytes],
+) -> Metadata:
 	"""
-	Build a metadata dictionary from the database.
-	Each entry in the dictionary is a PostInfo object.
-	The key is the post_id of the post.
-	Duplicate images will be merged into a single entry.
+	Build the metadata arrays from the database.
+	Each row of the returned Metadata is a post.
+	Duplicate images will be merged into a single row.
 	RATING_MAP is used to convert the rating string to an integer.
 	tag_string is split into a set of tags.
 	Tag aliases are applied to canonicalize tags.
 	Tag implications are applied to expand tags and make sure general tags are counted correctly.
 	For example, "mouse_ears" is an implication of "animal_ears", so if a post has "mouse_ears" it should be counted as having "animal_ears" as well.
 	"""
-	hash_to_duplicates_group_id = {hash: i for i, group in enumerate(duplicate_groups) for hash in group}
-	max_group_id = max(hash_to_duplicates_group_id.values(), default=-1)
-
-	print("Counting posts...")
+	print("Uploading duplicate groups...")
 	with db.cursor() as cur:
-		# Only count posts with embeddings (this excludes gif posts, for example)
-		cur.execute("SELECT COUNT(*) FROM metadata INNER JOIN embeddings ON metadata.file_hash = embeddings.hash")
+		cur.execute("CREATE TEMPORARY TABLE duplicate_groups (hash bytea PRIMARY KEY, canonical_hash bytea NOT NULL)")
+		with cur.copy("COPY duplicate_groups (hash, canonical_hash) FROM STDIN") as copy:
+			for item in hash_to_canonical.items():
+				copy.write_row(item)
+		cur.execute("ANALYZE duplicate_groups")
+
+	# A full COUNT(*) over the join would scan both tables just to size the progress bar, so use the planner's estimate instead
+	# Only posts with embeddings are processed (this excludes gif posts, for example)
+	with db.cursor() as cur:
+		cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'embeddings'")
 		result = cur.fetchone()
-		assert result is not None
-		total_posts, = result
+		estimated_posts = result[0] if result is not None and result[0] > 0 else None
 	
-	group_id_to_post_id: dict[int, int] = {}
-	metadata: dict[int, PostInfo] = {}
+	# The rating CASE in the main query would turn a rating missing from RATING_MAP into NULL, so fail clearly up front instead
+	with db.cursor() as cur:
+		cur.execute("SELECT DISTINCT metadata.rating FROM metadata INNER JOIN embeddings ON metadata.file_hash = embeddings.hash")
+		unknown_ratings = {rating for rating, in cur} - RATING_MAP.keys()
 	
-	print("Building metadata...")
-	with db.cursor("metadata_query") as cur:
-		cur.execute("SELECT metadata.post_id, metadata.tag_string, metadata.file_hash, metadata.score, metadata.rating FROM metadata INNER JOIN embeddings ON metadata.file_hash = embeddings.hash")
-
-		for row in tqdm(cur, total=total_posts):
-			post = PostInfo(
-				post_id=row[0],
-				tags=set(t.strip() for t in row[1].split(' ')),
-				hash=bytes(row[2]),
-				score=row[3],
-				rating=RATING_MAP[row[4]],
-			)
-
-			# Apply tag aliases
-			post.tags = set(tag_mappings.get_canonical(tag) for tag in post.tags)
-
-			# Apply tag implications
-			for tag in list(post.tags):
-				post.tags.update(tag_mappings.get_implications(tag))
-
-			# Remove blacklisted tags
-			post.tags.difference_update(tag_mappings.blacklist)
-
-			# Remove deprecated tags
-			post.tags.difference_update(tag_mappings.deprecations)
-
-			# Combine the data for duplicates
-			# Groups of duplicate images will be merged into a single entry in metadata
-			# The post_id of the first encountered image in a group will be used as the key
-			# The tags of all images in the group will be merged
-			# The highest score and rating will be used
-			if post.hash in hash_to_duplicates_group_id:
-				group_id = hash_to_duplicates_group_id[post.hash]
-
-				if group_id not in group_id_to_post_id:
-					group_id_to_post_id[group_id] = post.post_id
-					metadata[post.post_id] = post
-				
-				group_post = metadata[group_id_to_post_id[group_id]]
-				group_post.tags.update(post.tags)
-				group_post.score = max(group_post.score, post.score)
-				group_post.rating = max(group_post.rating, post.rating)
+	assert not unknown_ratings, f"Ratings missing from RATING_MAP: {', '.join(sorted(map(str, unknown_ratings)))}"
+	
+	print("Building tag expansion table...")
+	with db.cursor() as cur:
+		# Only the tags of posts that are processed (those with embeddings) need expanding
+		cur.execute("SELECT DISTINCT unnest(string_to_array(metadata.tag_string, ' ')) FROM metadata INNER JOIN embeddings ON metadata.file_hash = embeddings.hash")
+		expansion_table = tag_mappings.build_expansion_table(tag for tag, in cur)
+
+	# The expansion table is uploaded so that Postgres can expand each post's tags while streaming it
+	# Tags are stored as integer ids, indexing into expansion_table.tag_names
+	print("Uploading tag expansion table...")
+	with db.cursor() as cur:
+		cur.execute("CREATE TEMPORARY TABLE tag_expansions (tag text PRIMARY KEY, tag_ids integer[] NOT NULL)")
+		with cur.copy("COPY tag_expansions (tag, tag_ids) FROM STDIN") as copy:
+			copy.set_types(["text", "int4[]"])
+			for item in expansion_table.expansions.items():
+				copy.write_row(item)
+		cur.execute("ANALYZE tag_expansions")
+
+	# Rows are filled in order of first appearance
+	post_ids = array('q')
+	scores = array('h')
+	ratings = array('b')
+	hashes: list[bytes] = []
+
+	# Tag ids are appended to a flat buffer as each row is created, rather than kept as a set per post
+	# Tags from later duplicates are collected separately, and only for the rows that have duplicates
+	tag_lengths = array('q')
+	tag_data = array('i')
+	duplicate_tags: dict[int, set[int]] = defaultdict(set)
+
+	# Maps a duplicate group's canonical hash to the row its data is merged into
+	# Posts that aren't in any group are their own group, keyed by their hash, to catch exact duplicates
+	group_hash_to_index: dict[bytes, int] = {}
+
+	def merge_batch(batch: list[MetadataRow]) -> None:
+		# Combine the data for duplicates
+		# Groups of duplicate images will be merged into a single row
+		# The post_id of the first encountered image in a group will be used
+		# The tags of all images in the group will be merged
+		# The highest score and rating will be used
+		# This runs once per row, so methods are bound to locals and each row costs one dict operation
+		assign_index = group_hash_to_index.setdefault
+		append_post_id, append_score, append_rating, append_hash = post_ids.append, scores.append, ratings.append, hashes.append
+		append_tag_length, extend_tag_data = tag_lengths.append, tag_data.extend
+		n_rows = len(hashes)
+
+		for post_id, tags, file_hash, score, rating, group_hash in batch:
+			index = assign_index(group_hash, n_rows)
+
+			if index == n_rows:
+				n_rows += 1
+				append_post_id(post_id)
+				append_score(score)
+				append_rating(rating)
+				append_hash(file_hash)
+				append_tag_length(len(tags))
+				extend_tag_data(tags)
 			else:
-				metadata[post.post_id] = post
+				duplicate_tags[index].update(tags)
+				# Compared by hand rather than with max(), which costs a call and an array store for every duplicate
+				if score > scores[index]:  # noqa: PLR1730
+					scores[index] = score
+				if rating > ratings[index]:  # noqa: PLR1730
+					ratings[index] = rating
 
-				# Create a new duplicate group, to catch exact duplicates
-				max_group_id += 1
-				hash_to_duplicates_group_id[post.hash] = max_group_id
-				group_id_to_post_id[max_group_id] = post.post_id
+	print("Building metadata...")
+
+	# Postgres splits tag_string and expands it into distinct tag ids through the expansion table
+	# Aliases, implications, blacklist, and deprecations are all baked into the expansion table
+	# It also maps ratings to integers (using RATING_MAP), and resolves each post's duplicate group hash
+	rating_case = " ".join(f"WHEN '{rating}' THEN {value}" for rating, value in RATING_MAP.items())
+	query = f"""
+		SELECT
+			metadata.post_id::bigint,
+			ARRAY(
+				SELECT DISTINCT tag_id
+				FROM unnest(string_to_array(metadata.tag_string, ' ')) AS raw_tags(tag)
+				INNER JOIN tag_expansions ON tag_expansions.tag = raw_tags.tag
+				CROSS JOIN unnest(tag_expansions.tag_ids) AS tag_id
+			),
+			metadata.file_hash,
+			metadata.score::integer,
+			CASE metadata.rating {rating_case} END,
+			COALESCE(duplicate_groups.canonical_hash, metadata.file_hash)
+		FROM metadata
+		INNER JOIN embeddings ON metadata.file_hash = embeddings.hash
+		LEFT JOIN duplicate_groups ON metadata.file_hash = duplicate_groups.hash
+	"""
+
+	# The rows are streamed with a binary COPY, which has less per-row protocol overhead than fetching from a cursor
+	# Binary COPY needs the exact column types, hence the casts in the query
+	with db.cursor() as cur, cur.copy(f"COPY ({query}) TO STDOUT (FORMAT BINARY)") as copy, tqdm(total=estimated_posts) as pbar:
+		copy.set_types(["int8", "int4[]", "bytea", "int4", "int4", "bytea"])
+
+		for batch in prefetch_batches(copy.rows(), BATCH_SIZE):
+			merge_batch(batch)
+			pbar.update(len(batch))
 	
-	print(f"{total_posts - len(metadata)} duplicate posts removed")
+	n_posts = len(hashes)
+	print(f"{pbar.n - n_posts} duplicate posts removed")
 
-	return metadata
+	tag_indptr, tag_data_np = merge_duplicate_tags(np.frombuffer(tag_lengths, dtype=np.int64), np.frombuffer(tag_data, dtype=np.int32), duplicate_tags)
 
+	return Metadata(
+		post_ids=np.frombuffer(post_ids, dtype=np.int64),
+		hashes=np.frombuffer(b"".join(hashes), dtype=np.uint8).reshape(n_posts, 32),
+		scores=np.frombuffer(scores, dtype=np.int16),
+		ratings=np.frombuffer(ratings, dtype=np.int8),
+		tag_indptr=tag_indptr,
+		tag_data=tag_data_np,
+		tag_names=expansion_table.tag_names,
+	)
 
-def count_tags(metadata) -> dict[str, int]:
+
+def merge_duplicate_tags(tag_lengths: np.ndarray, tag_data: np.ndarray, duplicate_tags: dict[int, set[int]]) -> tuple[np.ndarray, np.ndarray]:
 	"""
-	Count the number of times each tag appears in the metadata.
+	Merge the tags of duplicate posts into the CSR tag arrays of their group's row.
+	tag_lengths and tag_data hold each row's own tags, in row order.
+	duplicate_tags maps a row index to the tags of all the later duplicates merged into that row.
+	Returns the merged (tag_indptr, tag_data).
 	"""
-	tag_counts = {}
-	max_tags = 0
-	min_tags = 999999999
-	sum_tags = 0
+	tag_indptr = np.zeros(len(tag_lengths) + 1, dtype=np.int64)
+	np.cumsum(tag_lengths, out=tag_indptr[1:])
 
-	for post in metadata.values():
-		for tag in post.tags:
-			tag_counts[tag] = tag_counts.get(tag, 0) + 1
-		
-		min_tags = min(min_tags, len(post.tags))
-		max_tags = max(max_tags, len(post.tags))
-		sum_tags += len(post.tags)
+	if not duplicate_tags:
+		return tag_indptr, tag_data
 
-	mean_tags = sum_tags / len(metadata)
+	# Only the tags a row doesn't already have are added
+	added_rows = array('q')
+	added_data = array('i')
 
-	print(f"Min tags: {min_tags}")
-	print(f"Max tags: {max_tags}")
-	print(f"Mean tags: {mean_tags}")
+	for index in sorted(duplicate_tags):
+		new_tags = duplicate_tags[index].difference(tag_data[tag_indptr[index]:tag_indptr[index + 1]].tolist())
+		added_rows.extend(repeat(index, len(new_tags)))
+		added_data.extend(new_tags)
 
-	return tag_counts
+	# Each added tag is inserted at the end of its row, in a single copy of tag_data
+	# np.insert keeps the given order for equal positions, and added_rows is sorted, so no sort is needed
+	added_rows_np = np.frombuffer(added_rows, dtype=np.int64)
+	tag_data = np.insert(tag_data, tag_indptr[added_rows_np + 1], np.frombuffer(added_data, dtype=np.int32))
+	tag_lengths = tag_lengths + np.bincount(added_rows_np, minlength=len(tag_lengths))
+	np.cumsum(tag_lengths, out=tag_indptr[1:])
 
+	return tag_indptr, tag_data
 
-def write_metadata_parquet(metadata: dict[int, PostInfo], top_tags: list[str]) -> None:
+
+def prefetch_batches(rows: Iterable[tuple[Any, ...]], size: int, max_prefetch: int = 8) -> Iterator[list[tuple[Any, ...]]]:
 	"""
-	Write the metadata to a Parquet file.
-	The tags field of each PostInfo object is converted to a list of integers, based on the top_tags list.
+	Yields batches of rows from the iterable, read ahead by a background thread.
+	This overlaps waiting on Postgres with processing of earlier batches; libpq releases the GIL while it waits.
+	At most max_prefetch batches are buffered.
 	"""
-	top_tags_map = {tag: i for i, tag in enumerate(top_tags)}
-
-	def transform(post: PostInfo) -> Tuple[int, list[int], bytes, int, int]:
-		return (
-			post.post_id,
-			[top_tags_map[tag] for tag in post.tags if tag in top_tags_map],
-			post.hash,
-			post.rating,
-			post.score,
-		)
+	batches: Queue[list[tuple[Any, ...]] | BaseException] = Queue(maxsize=max_prefetch)
+	# Set when the consumer stops early, so the thread stops reading rows from the connection
+	stop = threading.Event()
+
+	def fetch() -> None:
+		try:
+			iterator = iter(rows)
+			while not stop.is_set() and (batch := list(islice(iterator, size))):
+				batches.put(batch)
+			batches.put([])
+		# Anything raised here, including KeyboardInterrupt, is handed to the consumer and re-raised there
+		except BaseException as e:  # noqa: BLE001
+			batches.put(e)
 	
-	posts = (transform(post) for post in metadata.values())
-	posts = batcher(posts, 1000)
+	thread = threading.Thread(target=fetch, daemon=True)
+	thread.start()
 
-	with pq.ParquetWriter("metadata.parquet", schema) as writer:
-		for batch in posts:
-			post_ids, tags, hashes, ratings, scores = zip(*batch)
+	try:
+		while True:
+			batch = batches.get()
 
-			batch = pa.RecordBatch.from_arrays([
-				pa.array(post_ids, type=pa.int64()),
-				pa.array(tags, type=pa.list_(pa.int16())),
-				pa.array(hashes, type=pa.binary(32)),
-				pa.array(ratings, type=pa.int8()),
-				pa.array(scores, type=pa.int16()),
-			], schema=schema)
-			writer.write(batch)
+			if isinstance(batch, BaseException):
+				raise batch
 
+			if not batch:
+				break
 
-def get_db_connection() -> psycopg.Connection[Tuple[Any, ...]]:
-	return psycopg.connect("dbname=postgres user=postgres", host=str((Path.cwd() / ".." / "pg-socket").absolute()))
+			yield batch
+	finally:
+		# The thread must be finished before the caller closes the COPY, since both would be using the connection
+		# Draining the queue unblocks a pending put, after which the thread sees the stop flag
+		stop.set()
+		while thread.is_alive():
+			while not batches.empty():
+				batches.get_nowait()
+			thread.join(timeout=0.1)
+
+
+def count_tags(metadata: Metadata) -> dict[str, int]:
+	"""
+	Count the number of times each tag appears in the metadata.
+	"""
+	tag_counts = np.bincount(metadata.tag_data, minlength=len(metadata.tag_names))
+	tag_lengths = np.diff(metadata.tag_indptr)
 
+	print(f"Min tags: {tag_lengths.min()}")
+	print(f"Max tags: {tag_lengths.max()}")
+	print(f"Mean tags: {tag_lengths.mean()}")
 
-def batcher(iterable, n):
-	iterator = iter(iterable)
-	while batch := list(islice(iterator, n)):
-		yield batch
+	return {metadata.tag_names[i]: int(tag_counts[i]) for i in np.flatnonzero(tag_counts)}
+
+
+def write_metadata_parquet(metadata: Metadata, top_tags: list[str]) -> None:
+	"""
+	Write the metadata to a Parquet file.
+	The tags of each post are converted to a list of integers, based on the top_tags list.
+	"""
+	# Lookup table from tag id to index in top_tags, or -1 if the tag is not a top tag
+	tag_ids = {tag: i for i, tag in enumerate(metadata.tag_names)}
+	top_tags_lut = np.full(len(metadata.tag_names), -1, dtype=np.int16)
+	top_tags_lut[np.array([tag_ids[tag] for tag in top_tags], dtype=np.int64)] = np.arange(len(top_tags), dtype=np.int16)
+
+	top_tag_data = top_tags_lut[metadata.tag_data]
+	is_top_tag = top_tag_data >= 0
+	top_tag_data = top_tag_data[is_top_tag]
+
+	# Offsets are computed directly as int32, the offset type of Arrow lists
+	top_tag_offsets = np.zeros(len(is_top_tag) + 1, dtype=np.int32)
+	np.cumsum(is_top_tag, dtype=np.int32, out=top_tag_offsets[1:])
+	top_tag_offsets = top_tag_offsets[metadata.tag_indptr]
+
+	# Every column is built straight from its NumPy buffer, without going through Python objects
+	n_posts = len(metadata)
+	tags = pa.Array.from_buffers(
+		pa.list_(pa.int16()),
+		n_posts,
+		[None, pa.py_buffer(top_tag_offsets)],
+		children=[pa.Array.from_buffers(pa.int16(), len(top_tag_data), [None, pa.py_buffer(top_tag_data)])],
+	)
+	columns = [
+		pa.array(metadata.post_ids, type=pa.int64()),
+		tags,
+		pa.FixedSizeBinaryArray.from_buffers(pa.binary(32), n_posts, [None, pa.py_buffer(metadata.hashes)]),
+		pa.array(metadata.ratings, type=pa.int8()),
+		pa.array(metadata.scores, type=pa.int16()),
+	]
+
+	# Tag ids, ratings, and scores are low cardinality and repeat heavily, so they get dictionary encoding
+	# Post ids are unique and hashes are random bytes, so dictionaries would only add overhead for them
+	# Hashes don't compress either, so compression is skipped for them; everything else uses zstd
+	writer = pq.ParquetWriter(
+		"metadata.parquet",
+		schema,
+		compression={"post_id": "zstd", TAGS_COLUMN_PATH: "zstd", "hash": "none", "rating": "zstd", "score": "zstd"},
+		compression_level={"post_id": 3, TAGS_COLUMN_PATH: 3, "rating": 3, "score": 3},
+		use_dictionary=[TAGS_COLUMN_PATH, "rating", "score"],
+		write_statistics=True,
+		write_batch_size=64_000,
+		data_page_size=1 << 20,
+	)
+
+	# Slicing is zero-copy, so each row group is just a view into the full columns
+	with writer:
+		for start in range(0, n_posts, ROW_GROUP_SIZE):
+			writer.write_batch(pa.RecordBatch.from_arrays([column.slice(start, ROW_GROUP_SIZE) for column in columns], schema=schema))
+
+
+def get_db_connection() -> psycopg.Connection[Tuple[Any, ...]]:
+	return psycopg.connect("dbname=postgres user=postgres", host=str((Path.cwd() / ".." / "pg-socket").absolute()))
 
 
 if __name__ == '__main__':
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
+import os
+import pickle
+import tempfile
 from collections import defaultdict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
+from sys import intern
 
-from pydantic import BaseModel
+import numpy as np
+import orjson
 
 
 RATING_MAP = {
@@ -12,75 +21,200 @@ RATING_MAP = {
 	'e': 2,
 }
 
+# Files in the metadata directory that TagMappings is built from
+TAG_MAPPING_FILES = ('tag_aliases000000000000.json', 'tag_implications000000000000.json', 'tag_blacklist.txt', 'tag_deprecations.txt')
+
+# Version of the TagMappings pickle cache format and build logic
+TAG_MAPPINGS_CACHE_VERSION = 1
 
-@dataclass
-class PostInfo:
-	post_id: int
-	tags: set[str]
-	hash: bytes
-	score: int
-	rating: int
 
+@dataclass
+class Metadata:
+	"""
+	Post metadata stored as a structure of arrays, one row per post.
+	Tags are stored in CSR form: the tags of post i are tag_data[tag_indptr[i]:tag_indptr[i + 1]], as indices into tag_names.
+	"""
+	post_ids: np.ndarray  # int64[N]
+	hashes: np.ndarray  # uint8[N, 32]
+	scores: np.ndarray  # int16[N]
+	ratings: np.ndarray  # int8[N]
+	tag_indptr: np.ndarray  # int64[N + 1]
+	tag_data: np.ndarray  # int32[total_tags]
+	tag_names: list[str]
 
-class TagAlias(BaseModel):
-	antecedent_name: str
-	consequent_name: str
-	status: str
+	def __len__(self) -> int:
+		return len(self.post_ids)
 
 
-class TagImplication(BaseModel):
-	antecedent_name: str
-	consequent_name: str
-	status: str
+@dataclass
+class TagExpansionTable:
+	"""
+	Maps raw tags to the sorted ids of the final tags each one expands to.
+	Tag ids are indices into tag_names.
+	"""
+	tag_names: list[str]
+	expansions: dict[str, list[int]]
 
 
 class TagMappings:
 	aliases: dict[str, str]
-	implications: dict[str, set[str]]
+	implications: dict[str, frozenset[str]]
 	blacklist: set[str]
 	deprecations: set[str]
 
 	def __init__(self, metadata_dir: Path | str):
 		metadata_dir = Path(metadata_dir)
-		self.aliases = read_tag_aliases(metadata_dir)
-		self.implications = read_tag_implications(metadata_dir)
-		self.blacklist = read_tag_blacklist(metadata_dir)
-		self.deprecations = read_tag_deprecations(metadata_dir)
 
-		# Canonicalize tag implications by applying tag aliases
-		self.implications = {
-			self.get_canonical(tag): set(self.get_canonical(implied_tag) for implied_tag in implied_tags)
-			for tag, implied_tags in self.implications.items()
-		}
+		# The four files are independent, so they're read concurrently; file reads release the GIL
+		with ThreadPoolExecutor(max_workers=4) as executor:
+			aliases_future = executor.submit(read_tag_aliases, metadata_dir)
+			implications_future = executor.submit(read_tag_implications, metadata_dir)
+			blacklist_future = executor.submit(read_tag_blacklist, metadata_dir)
+			deprecations_future = executor.submit(read_tag_deprecations, metadata_dir)
+
+			self.aliases = aliases_future.result()
+			self.implications = implications_future.result()
+			self.blacklist = blacklist_future.result()
+			self.deprecations = deprecations_future.result()
+
+		# Canonicalize tag implications by applying tag aliases, in a single pass with dict.get bound to a local
+		# Antecedents that alias to the same tag have their implications merged, rather than one overwriting the other
+		# Aliasing can turn an implication into a tag implying itself, which is dropped
+		get = self.aliases.get
+		implications: dict[str, set[str]] = {}
+
+		for tag, implied_tags in self.implications.items():
+			tag = get(tag, tag)
+			canonical_implied_tags = implications.setdefault(tag, set())
+			canonical_implied_tags.update(get(implied_tag, implied_tag) for implied_tag in implied_tags)
+			canonical_implied_tags.discard(tag)
 
 		# Expand tag implications
 		# This condenses chains of implications into a single mapping
 		# For example, if "a" implies "b" and "b" implies "c", then "a" implies "b" and "c"
-		while True:
-			implication_updates = {}
+		# Tags are processed in reverse topological order (Kahn's algorithm, starting from tags that imply nothing with further implications),
+		# so every tag a tag implies already has its full closure, and each tag takes a single union over them
+		implied_by: dict[str, list[str]] = defaultdict(list)
+		n_unresolved: dict[str, int] = {}
+
+		for tag, implied_tags in implications.items():
+			n_unresolved[tag] = 0
+
+			for implied_tag in implied_tags:
+				if implied_tag in implications:
+					implied_by[implied_tag].append(tag)
+					n_unresolved[tag] += 1
+
+		ready = [tag for tag, n in n_unresolved.items() if n == 0]
+		closures: dict[str, frozenset[str]] = {}
+		empty: frozenset[str] = frozenset()
+
+		while ready:
+			tag = ready.pop()
+			implied_tags = implications[tag]
+			closure = set(implied_tags)
+
+			for implied_tag in implied_tags:
+				closure |= closures.get(implied_tag, empty)
+			
+			# Frozen, so that unions over many implication sets during metadata building stay cheap
+			closures[tag] = frozenset(closure)
 
-			for tag, implied_tags in self.implications.items():
-				new_implications = (self.get_implications(implied_tag) for implied_tag in implied_tags)
-				new_implications = set.union(*new_implications)
-				new_implications = new_implications.difference(implied_tags)
+			for parent in implied_by[tag]:
+				n_unresolved[parent] -= 1
 
-				if len(new_implications) > 0:
-					implication_updates[tag] = new_implications
-			
-			if len(implication_updates) == 0:
-				break
+				if n_unresolved[parent] == 0:
+					ready.append(parent)
+		
+		# Tags left unresolved are on, or imply a tag on, a cycle; the old fixed-point loop would have silently absorbed these
+		unresolved = sorted(implications.keys() - closures.keys())
+		assert len(unresolved) == 0, f"Cycles found in tag implications, involving: {', '.join(unresolved[:20])}"
 
-			for tag, new_implications in implication_updates.items():
-				self.implications[tag].update(new_implications)
+		self.implications = closures
+	
+	@classmethod
+	def load_or_build(cls, metadata_dir: Path | str, cache_path: Path | str) -> 'TagMappings':
+		"""
+		Returns the TagMappings for metadata_dir, loaded from the pickle at cache_path if the source files haven't changed since it was written.
+		Otherwise they're built from the source files, and the cache is (re)written.
+		"""
+		metadata_dir = Path(metadata_dir)
+		cache_path = Path(cache_path)
+
+		# Bump TAG_MAPPINGS_CACHE_VERSION whenever the way mappings are built changes, so stale caches are rebuilt
+		source_stats = ((metadata_dir / name).stat() for name in TAG_MAPPING_FILES)
+		key = (TAG_MAPPINGS_CACHE_VERSION, str(metadata_dir.resolve()), *((stat.st_mtime_ns, stat.st_size) for stat in source_stats))
+
+		# A cache that can't be read, or was written in an older format, is treated as a miss and rebuilt
+		try:
+			with open(cache_path, 'rb') as f:
+				cached_key, state = pickle.load(f)
+		except (FileNotFoundError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+			cached_key, state = None, None
+		
+		if cached_key == key and isinstance(state, dict):
+			mappings = cls.__new__(cls)
+			mappings.__dict__.update(state)
+			return mappings
+		
+		mappings = cls(metadata_dir)
+
+		# Written to a temporary file and moved into place, so an interrupted run can't leave a truncated cache behind
+		# The cache is only an optimization, so failing to write it is reported rather than losing the mappings
+		temp_path = None
+
+		try:
+			with tempfile.NamedTemporaryFile('wb', dir=cache_path.parent, prefix=cache_path.name + '.', suffix='.tmp', delete=False) as f:
+				temp_path = Path(f.name)
+				pickle.dump((key, mappings.__dict__), f, protocol=pickle.HIGHEST_PROTOCOL)
+			
+			os.replace(temp_path, cache_path)
+			temp_path = None
+		except OSError as e:
+			print(f"Failed to write tag mappings cache to {cache_path}: {e}")
+		finally:
+			if temp_path is not None:
+				temp_path.unlink(missing_ok=True)
+		
+		return mappings
 	
 	def get_canonical(self, tag: str) -> str:
 		"""Returns the canonical name for a tag, based on aliases."""
 		return self.aliases.get(tag, tag)
 	
-	def get_implications(self, tag: str) -> set[str]:
+	def get_implications(self, tag: str) -> frozenset[str]:
 		"""Returns a set of all tags implied by the given tag."""
 		tag = self.get_canonical(tag)
-		return self.implications.get(tag, set())
+		return self.implications.get(tag, frozenset())
+	
+	def build_expansion_table(self, tags: Iterable[str]) -> TagExpansionTable:
+		"""
+		Returns a table mapping raw tags to the ids of the final tags each one expands to.
+		Aliases and implications are applied, then blacklisted and deprecated tags are removed.
+		Since all of these are static, a post's tags can be computed as the union of its raw tags' entries.
+		Raw tags are stripped of whitespace here, once per distinct tag, and empty tags expand to nothing.
+		Only tags that some raw tag expands to get an id, so aliased away, blacklisted, and deprecated tags never do.
+		"""
+		removed_tags = self.blacklist | self.deprecations
+		expanded: dict[str, frozenset[str]] = {}
+
+		for tag in tags:
+			stripped = tag.strip()
+
+			if stripped == '':
+				expanded[tag] = frozenset()
+				continue
+
+			canonical = self.get_canonical(stripped)
+			expanded[tag] = frozenset(({canonical} | self.implications.get(canonical, frozenset())) - removed_tags)
+		
+		tag_names = sorted(frozenset().union(*expanded.values()))
+		tag_ids = {tag: i for i, tag in enumerate(tag_names)}
+
+		return TagExpansionTable(
+			tag_names=tag_names,
+			expansions={tag: sorted(map(tag_ids.__getitem__, expanded_tags)) for tag, expanded_tags in expanded.items()},
+		)
 
 
 def read_tag_aliases(metadata_dir: Path) -> dict[str, str]:
@@ -89,20 +223,28 @@ def read_tag_aliases(metadata_dir: Path) -> dict[str, str]:
 	This maps from aliased tags back to a canonical tag.
 	Given a tag like "ff7" as key, for example, the value would be "final_fantasy_vii".
 	"""
-	aliases = [TagAlias.model_validate_json(line) for line in open(metadata_dir / 'tag_aliases000000000000.json', 'r')]
 	alias_map = {}
 
-	for alias in aliases:
-		if alias.status != 'active':
+	# Plain orjson dicts; only three fields are needed, so per-line model validation isn't worth its cost
+	# The file is read in one go and split in C, rather than iterated line by line
+	for line in (metadata_dir / 'tag_aliases000000000000.json').read_bytes().splitlines():
+		if line.strip() == b'':
+			continue
+
+		alias = orjson.loads(line)
+
+		if alias['status'] != 'active':
 			continue
 
-		assert alias.antecedent_name != alias.consequent_name, "Self-aliases found in tag aliases"
+		antecedent, consequent = intern(alias['antecedent_name']), intern(alias['consequent_name'])
+
+		assert antecedent != consequent, "Self-aliases found in tag aliases"
 
 		# Duplicate antecedent->consequent mappings are allowed, but only if they are the same
 		# This is because the dataset contains a few duplicates (unknown why)
-		assert alias.antecedent_name not in alias_map or alias_map[alias.antecedent_name] == alias.consequent_name, "Duplicate antecedents found in tag aliases"
+		assert antecedent not in alias_map or alias_map[antecedent] == consequent, "Duplicate antecedents found in tag aliases"
 
-		alias_map[alias.antecedent_name] = alias.consequent_name
+		alias_map[antecedent] = consequent
 
 	# Check for chains by ensuring that consequents are not also antecedents
 	assert all(consequent not in alias_map for consequent in alias_map.values()), "Chains found in tag aliases"
@@ -111,37 +253,56 @@ def read_tag_aliases(metadata_dir: Path) -> dict[str, str]:
 
 
 def read_tag_implications(metadata_dir: Path) -> dict[str, set[str]]:
-	"""Returns a dictionary of tag implications. Given a tag like "mouse_ears" as key, for example, the value would be "animal_ears"."""
-	implications = defaultdict(set)
+	"""
+	Returns a dictionary of tag implications. Given a tag like "mouse_ears" as key, for example, the value would be "animal_ears".
+	Tag names are interned, since the same consequent shows up in many implications.
+	"""
+	pairs = []
+
+	for line in (metadata_dir / 'tag_implications000000000000.json').read_bytes().splitlines():
+		if line.strip() == b'':
+			continue
 
-	with open(metadata_dir / 'tag_implications000000000000.json', 'r') as f:
-		for line in f:
-			implication = TagImplication.model_validate_json(line)
+		implication = orjson.loads(line)
 
-			if implication.status != 'active':
-				continue
+		if implication['status'] != 'active':
+			continue
 
-			implications[implication.antecedent_name].add(implication.consequent_name)
+		pairs.append((intern(implication['antecedent_name']), intern(implication['consequent_name'])))
 	
-	return implications
+	# Sorting groups the pairs by antecedent, so each antecedent is hashed once and each set is built in one go
+	pairs.sort(key=itemgetter(0))
+
+	return {antecedent: {consequent for _, consequent in group} for antecedent, group in groupby(pairs, key=itemgetter(0))}
 
 
 def read_tag_blacklist(metadata_dir: Path) -> set[str]:
 	"""Returns a set of blacklisted tags."""
-	with open(metadata_dir / 'tag_blacklist.txt', 'r') as f:
-		return set(line.strip() for line in f.read().splitlines() if line.strip() != '')
+	return set(map(intern, (metadata_dir / 'tag_blacklist.txt').read_text().split()))
 
 
 def read_tag_deprecations(metadata_dir: Path) -> set[str]:
 	"""Returns a set of deprecated tags."""
-	with open(metadata_dir / 'tag_deprecations.txt', 'r') as f:
-		return set(line.strip() for line in f.read().splitlines() if line.strip() != '')
+	return set(map(intern, (metadata_dir / 'tag_deprecations.txt').read_text().split()))
 
 
-def read_duplicates() -> list[set[bytes]]:
-	"""Returns a list of duplicate images. Each item in the list is a `set` with a list of all hashes in that group."""
-	groups = open('duplicates.txt', 'r').read().splitlines()
-	groups = (group.split(' ') for group in groups)
-	groups = (set(bytes.fromhex(x) for x in group) for group in groups)
-
-	return list(groups)
\ No newline at end of file
+def read_duplicates() -> dict[bytes, bytes]:
+	"""
+	Returns a mapping from image hash to the canonical hash of its duplicate group.
+	Each line of duplicates.txt is a group, and the first hash on the line is used as the group's canonical hash.
+	"""
+	hash_to_canonical = {}
+
+	for line in Path('duplicates.txt').read_bytes().splitlines():
+		# Decode the whole line at once (fromhex skips the separating spaces), then slice out the 32 byte hashes
+		group = bytes.fromhex(line.decode())
+		# Hashes of the wrong lengths can still add up to a multiple of 32 bytes, so check that each one is 64 hex digits
+		# followed by a single space, which also rules out any other whitespace that fromhex would have skipped
+		n_hashes = (len(line) + 1) // 65
+		assert len(group) == 32 * n_hashes and line[64::65] == b' ' * (n_hashes - 1), "Malformed hash found in duplicates.txt"
+		canonical = group[:32]
+
+		for i in range(0, len(group), 32):
+			hash_to_canonical[group[i:i + 32]] = canonical
+	
+	return hash_to_canonical